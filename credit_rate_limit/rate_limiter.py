@@ -7,59 +7,141 @@ in addition to those just counting the number of requests per time unit
 * Doc: https://github.com/Elnaril/credit-rate-limit
 """
 import asyncio
-from dataclasses import dataclass
+from collections import deque
 from functools import wraps
+from itertools import count
 import logging
 from typing import (
     Any,
+    Deque,
+    Dict,
     Optional,
     Protocol,
+    Tuple,
     Union,
 )
-from uuid import uuid4
 
 
 logger = logging.getLogger(__name__)
 
+_next_limiter_id = count(1).__next__
+
 
-@dataclass
 class CreditState:
-    name: str
-    available: int
-    max: int
-    interval: float
-    delay: float
+    # slotted because 'available', 'max' and friends are read several times on
+    # every acquisition
+    __slots__ = (
+        "name",
+        "available",
+        "max",
+        "interval",
+        "delay",
+        "low_watermark",
+        "waiters",
+        "pending_releases",
+        "timer_handle",
+        "bound_loop",
+    )
+
+    def __init__(self, name: str, available: int, max: int, interval: float, delay: float, low_watermark: int) -> None:
+        self.name = name
+        self.available = available
+        self.max = max
+        self.interval = interval
+        self.delay = delay
+        self.low_watermark = low_watermark
+        self.waiters: Deque[Tuple[int, "asyncio.Future[None]"]] = deque()
+        self.pending_releases: Deque[Tuple[float, int]] = deque()
+        self.timer_handle: Optional[asyncio.TimerHandle] = None
+        self.bound_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def attach_to_running_loop(self) -> asyncio.AbstractEventLoop:
+        # release times, the timer and the waiter futures all belong to one
+        # event loop; when the limiter outlives it (e.g. successive
+        # asyncio.run calls), none of them can ever fire on the new loop, so
+        # start over from a full allowance
+        loop = asyncio.get_running_loop()
+        if self.bound_loop is not loop:
+            if self.bound_loop is not None:
+                self.available = self.max
+                self.waiters.clear()
+                self.pending_releases.clear()
+                self.timer_handle = None
+            self.bound_loop = loop
+        return loop
+
+    def schedule_release(self, request_credits: int) -> None:
+        # the delay is constant, so release times are appended in order and a
+        # single timer aimed at the head of the queue covers all of them
+        loop = self.attach_to_running_loop()
+        self.pending_releases.append((loop.time() + self.delay, request_credits))
+        if self.timer_handle is None:
+            self.timer_handle = loop.call_at(self.pending_releases[0][0], self.release_due_credits)
+
+    def release_due_credits(self) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        while self.pending_releases and self.pending_releases[0][0] <= now:
+            self.available += self.pending_releases.popleft()[1]
+        if self.available == self.max:
+            logger.debug(
+                "Credit Rate Limiter %s is back under its limit of %s credits per %s s",
+                self.name, self.max, self.interval,
+            )
+        if self.pending_releases:
+            self.timer_handle = loop.call_at(self.pending_releases[0][0], self.release_due_credits)
+        else:
+            self.timer_handle = None
+        self.wake_waiters()
+
+    def wake_waiters(self) -> None:
+        # grant waiters in FIFO order and stop at the first one that does not
+        # fit, so large requests are not starved by smaller ones
+        while self.waiters:
+            needed, future = self.waiters[0]
+            if future.cancelled():
+                self.waiters.popleft()
+                continue
+            if needed > self.available:
+                break
+            self.waiters.popleft()
+            self.available -= needed
+            future.set_result(None)
 
 
 class CreditContextManager:
+    __slots__ = ("request_credits", "credit_state")
+
     def __init__(self, request_credits: int, credit_state: CreditState) -> None:
         self.request_credits = request_credits
         self.credit_state = credit_state
 
     async def __aenter__(self) -> "CreditContextManager":
-        while True:
-            if self.credit_state.available >= self.request_credits:
-                self.credit_state.available -= self.request_credits
-                if self.credit_state.available <= 0.1 * self.credit_state.max:
-                    logger.debug(
-                        f"Credit Rate Limiter {self.credit_state.name} is using more than 90% of its "
-                        f"{self.credit_state.max} credits per {self.credit_state.interval} s"
-                    )
-                break
-            await asyncio.sleep(0.1)
+        state = self.credit_state
+        loop = state.attach_to_running_loop()
+        if state.available >= self.request_credits and not state.waiters:
+            # uncontended fast path: take the credits without touching the queue
+            state.available -= self.request_credits
+        else:
+            future: "asyncio.Future[None]" = loop.create_future()
+            state.waiters.append((self.request_credits, future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # the credits were granted before the cancellation landed
+                    state.available += self.request_credits
+                    state.wake_waiters()
+                raise
+        if state.available <= state.low_watermark:
+            logger.debug(
+                "Credit Rate Limiter %s is using more than 90%% of its %s credits per %s s",
+                state.name, state.max, state.interval,
+            )
         return self
 
     async def __aexit__(self, exception_type: Any, exception_val: Any, exception_traceback: Any) -> None:
-        loop = asyncio.get_running_loop()
-        loop.call_later(self.credit_state.delay, self.release_credits)
-
-    def release_credits(self) -> None:
-        self.credit_state.available += self.request_credits
-        if self.credit_state.available == self.credit_state.max:
-            logger.debug(
-                f"Credit Rate Limiter {self.credit_state.name} is back under its limit of "
-                f"{self.credit_state.max} credits per {self.credit_state.interval} s"
-            )
+        self.credit_state.schedule_release(self.request_credits)
 
 
 class CreditRateLimiter:
@@ -72,15 +154,33 @@ class CreditRateLimiter:
         :param name: an optional name to easily identify the instance
         """
         self.credit_state = CreditState(
-            name=str(uuid4()) if name is None else name,
+            name=f"limiter-{_next_limiter_id()}" if name is None else name,
             available=max_credits,
             max=max_credits,
             interval=interval,
-            delay=max(0.0, interval - adjustment)
+            delay=max(0.0, interval - adjustment),
+            low_watermark=int(0.1 * max_credits),
         )
+        # call sites typically use a small fixed set of credit costs, and the
+        # managers are stateless, so one instance per cost is enough
+        self._context_managers: Dict[int, CreditContextManager] = {}
 
     def __call__(self, request_credits: int) -> CreditContextManager:
-        return CreditContextManager(request_credits, self.credit_state)
+        try:
+            return self._context_managers[request_credits]
+        except KeyError:
+            return self._context_managers.setdefault(
+                request_credits, CreditContextManager(request_credits, self.credit_state)
+            )
+
+    def reserve(self, total_credits: int) -> CreditContextManager:
+        """
+        Reserve total_credits in a single acquisition, e.g. for a batch of same-cost requests run with
+        asyncio.gather: the batch waits once instead of each request contending on the limiter individually.
+        :param total_credits: the combined cost in credits of the batch
+        :return: an async context manager debiting the credits on enter and returning them after the usual delay
+        """
+        return self(total_credits)
 
 
 class CountRateLimiter:
@@ -92,41 +192,82 @@ class CountRateLimiter:
         :param adjustment: optimisation parameter
         :param name: an optional name to easily identify the instance
         """
-        self.name = uuid4() if name is None else name
+        self.name = f"limiter-{_next_limiter_id()}" if name is None else name
         self.max_count = max_count
         self.interval = interval
-        self.semaphore = asyncio.Semaphore(self.max_count)
+        # bounded so a spurious extra release raises instead of silently
+        # widening the rate limit
+        self.semaphore = asyncio.BoundedSemaphore(self.max_count)
         self.delay = max(0.0, self.interval - adjustment)
+        self.pending_releases: Deque[float] = deque()
+        self.timer_handle: Optional[asyncio.TimerHandle] = None
+        self.bound_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def attach_to_running_loop(self) -> asyncio.AbstractEventLoop:
+        # same scheme as CreditState: the timer, the release times and the
+        # semaphore's internal futures all belong to one event loop, so when
+        # the limiter outlives it, start over from a full allowance
+        loop = asyncio.get_running_loop()
+        if self.bound_loop is not loop:
+            if self.bound_loop is not None:
+                self.semaphore = asyncio.BoundedSemaphore(self.max_count)
+                self.pending_releases.clear()
+                self.timer_handle = None
+            self.bound_loop = loop
+        return loop
 
     async def __aenter__(self) -> "CountRateLimiter":
+        self.attach_to_running_loop()
         await self.semaphore.acquire()
         if self.semaphore.locked():
             logger.debug(
-                f"Rate Limiter {self.name} has reached its limit of {self.max_count} calls per {self.interval} s"
+                "Rate Limiter %s has reached its limit of %s calls per %s s", self.name, self.max_count, self.interval
             )
         return self
 
     async def __aexit__(self, exception_type: Any, exception_val: Any, exception_traceback: Any) -> None:
+        # same single-timer scheme as CreditState: release times are appended
+        # in order since the delay is constant
+        loop = self.attach_to_running_loop()
+        self.pending_releases.append(loop.time() + self.delay)
+        if self.timer_handle is None:
+            self.timer_handle = loop.call_at(self.pending_releases[0], self.release_due_semaphores)
+
+    def release_due_semaphores(self) -> None:
         loop = asyncio.get_running_loop()
-        loop.call_later(self.delay, self.release_semaphore)
+        now = loop.time()
+        while self.pending_releases and self.pending_releases[0] <= now:
+            self.pending_releases.popleft()
+            self.release_semaphore()
+        if self.pending_releases:
+            self.timer_handle = loop.call_at(self.pending_releases[0], self.release_due_semaphores)
+        else:
+            self.timer_handle = None
 
     def release_semaphore(self) -> None:
-        if self.semaphore.locked():
+        was_at_limit = self.semaphore.locked()
+        self.semaphore.release()
+        if was_at_limit:
             logger.debug(
-                f"Rate Limiter {self.name} is back under its limit of {self.max_count} calls per {self.interval} s"
+                "Rate Limiter %s is back under its limit of %s calls per %s s", self.name, self.max_count, self.interval
             )
-        self.semaphore.release()
 
 
 class DecoratedSignature(Protocol):
+    __name__: str
+
     def __call__(self, *args: Any, **kwargs: Any) -> Any: ...
 
 
 def credit_rate_limit(rate_limiter: CreditRateLimiter, request_credits: int) -> Any:
     def decorator(func: DecoratedSignature) -> Any:
+        # the context manager carries no per-call state, so a single instance
+        # can be shared by all concurrent calls of the decorated function
+        context_manager = rate_limiter(request_credits)
+
         @wraps(func)
         async def wrapper(*args: Any, **kwargs: Any) -> Any:
-            async with rate_limiter(request_credits):
+            async with context_manager:
                 return await func(*args, **kwargs)
         return wrapper
     return decorator
@@ -145,13 +286,14 @@ def count_rate_limit(rate_limiter: CountRateLimiter) -> Any:
 def credit_rate_limit_with_attribute(attribute_name: str, request_credits: int) -> Any:
     def decorator(func: DecoratedSignature) -> Any:
         @wraps(func)
-        def wrapper(self_: CreditRateLimiter, *args: Any, **kwargs: Any) -> Any:
+        async def wrapper(self_: Any, *args: Any, **kwargs: Any) -> Any:
             credit_rate_limiter = getattr(self_, attribute_name)
             if not isinstance(credit_rate_limiter, CreditRateLimiter):
                 raise ValueError(
                     f"credit_rate_limiter must be of type CreditRateLimiter. Got {type(credit_rate_limiter)}"
                 )
-            return credit_rate_limit(credit_rate_limiter, request_credits)(func)(self_, *args, **kwargs)
+            async with credit_rate_limiter(request_credits):
+                return await func(self_, *args, **kwargs)
         return wrapper
     return decorator
 
@@ -159,11 +301,12 @@ def credit_rate_limit_with_attribute(attribute_name: str, request_credits: int)
 def count_rate_limit_with_attribute(attribute_name: str) -> Any:
     def decorator(func: DecoratedSignature) -> Any:
         @wraps(func)
-        def wrapper(self_: CountRateLimiter, *args: Any, **kwargs: Any) -> Any:
+        async def wrapper(self_: Any, *args: Any, **kwargs: Any) -> Any:
             rate_limiter = getattr(self_, attribute_name)
             if not isinstance(rate_limiter, CountRateLimiter):
                 raise ValueError(f"rate_limiter must be of type CountRateLimiter. Got {type(rate_limiter)}")
-            return count_rate_limit(rate_limiter)(func)(self_, *args, **kwargs)
+            async with rate_limiter:
+                return await func(self_, *args, **kwargs)
         return wrapper
     return decorator
 
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+import pytest
+import pytest_asyncio
+
+
+# a single synchronous callback holding the loop for this many (real) seconds fails the test
+BLOCKING_THRESHOLD = 0.01
+
+
+class VirtualClockEventLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop whose clock only moves when nothing is ready to run: instead of
+    sleeping until the next timer is due, it jumps its (monotonic) time
+    straight to that timer. The rate limiters schedule everything through
+    loop.call_later/call_at, so the whole suite runs in virtual time and
+    asyncio.sleep(1) costs nothing, while durations measured with loop.time()
+    stay exact.
+
+    It also records the longest *real* time spent in a single callback, to
+    catch synchronous work holding the loop (e.g. a sleep or lock held across
+    an await in the limiters), which the virtual-time duration assertions
+    cannot see. Callbacks are timed one by one, not per loop iteration: an
+    iteration legitimately drains every ready callback, so under load (a
+    thousand woken tasks, an xdist-loaded machine) a whole batch can exceed
+    the threshold without any single callback misbehaving.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._virtual_time = 0.0
+        self.max_blocking_time = 0.0
+
+    def time(self) -> float:
+        return self._virtual_time
+
+    def reset_max_blocking_time(self) -> None:
+        self.max_blocking_time = 0.0
+
+    def _timed(self, callback):
+        def run(*args):
+            started = time.perf_counter()
+            try:
+                callback(*args)
+            finally:
+                elapsed = time.perf_counter() - started
+                if elapsed > self.max_blocking_time:
+                    self.max_blocking_time = elapsed
+        return run
+
+    def call_soon(self, callback, *args, context=None):
+        return super().call_soon(self._timed(callback), *args, context=context)
+
+    def call_at(self, when, callback, *args, context=None):
+        # call_later delegates to call_at, so this covers both
+        return super().call_at(when, self._timed(callback), *args, context=context)
+
+    def _run_once(self) -> None:
+        # _ready/_scheduled are BaseEventLoop internals: when no callback is
+        # ready, jump to the next scheduled timer so select() never waits
+        if not self._ready and self._scheduled:
+            self._virtual_time = max(self._virtual_time, self._scheduled[0].when())
+        super()._run_once()
+
+
+def pytest_asyncio_loop_factories(config, item):
+    return {"virtual_clock": VirtualClockEventLoop}
+
+
+# loop_scope must match the tests' loop scope, otherwise the fixture would
+# observe the (session-scoped) fixture loop instead of the loop under test
+@pytest_asyncio.fixture(autouse=True, loop_scope="module")
+async def watch_loop_blocking(request):
+    loop = asyncio.get_running_loop()
+    if request.node.get_closest_marker("allow_loop_blocking") is None and isinstance(loop, VirtualClockEventLoop):
+        loop.reset_max_blocking_time()
+        request.node._virtual_clock_loop = loop
+    yield
+
+
+@pytest.hookimpl(wrapper=True)
+def pytest_runtest_call(item):
+    # checked after the call phase rather than in the fixture's teardown, so a
+    # violation is reported as a plain test failure instead of a teardown error
+    result = yield
+    loop = getattr(item, "_virtual_clock_loop", None)
+    if loop is not None and loop.max_blocking_time >= BLOCKING_THRESHOLD:
+        pytest.fail(
+            f"event loop was blocked for {loop.max_blocking_time:.3f}s by a single synchronous callback"
+        )
+    return result
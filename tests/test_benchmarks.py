@@ -0,0 +1,38 @@
+"""
+Microbenchmarks for the rate limiters' own per-call overhead.
+
+The functional tests measure durations dominated by (virtual) sleeps, so they cannot catch a
+regression in the acquire/release hot path itself. These benchmarks call an *unblocked*
+@throughput-decorated coroutine — the limiters are sized so no call ever waits — and time the
+full decorator + acquire + release round trip, event loop included.
+
+Run with: pytest tests/test_benchmarks.py -n0
+(pytest-benchmark disables itself under pytest-xdist)
+"""
+import asyncio
+
+from credit_rate_limit import (
+    CountRateLimiter,
+    CreditRateLimiter,
+    throughput,
+)
+
+
+def test_benchmark_count_throughput(benchmark):
+    rate_limiter = CountRateLimiter(10 ** 9, 1)
+
+    @throughput(rate_limiter=rate_limiter)
+    async def unblocked_api_call():
+        return 1
+
+    benchmark.pedantic(lambda: asyncio.run(unblocked_api_call()), rounds=100, iterations=10)
+
+
+def test_benchmark_credit_throughput(benchmark):
+    rate_limiter = CreditRateLimiter(10 ** 9, 1)
+
+    @throughput(rate_limiter, request_credits=40)
+    async def unblocked_api_call():
+        return 1
+
+    benchmark.pedantic(lambda: asyncio.run(unblocked_api_call()), rounds=100, iterations=10)
@@ -1,6 +1,5 @@
 import asyncio
 import logging
-import time
 
 import pytest
 
@@ -15,132 +14,203 @@ from credit_rate_limit.rate_limiter import (
 )
 
 
+def _build_call(rate_limiter, request_credits=None):
+    # one throughput-wrapped coroutine function per test, shared by all its calls
+    if request_credits is None:
+        # @count_rate_limit(rate_limiter=rate_limiter)
+        @throughput(rate_limiter=rate_limiter)
+        async def simulate_api_call():
+            await asyncio.sleep(1)
+    else:
+        # @credit_rate_limit(rate_limiter=rate_limiter, request_credits=request_credits)
+        @throughput(rate_limiter, request_credits=request_credits)
+        async def simulate_api_call():
+            await asyncio.sleep(1)
+    return simulate_api_call
+
+
 @pytest.mark.parametrize(
-    "name, adjustment, calls, expected_logs, unexpected_logs, expected_duration",
+    "limiter_factory, request_credits, calls, expected_logs, unexpected_logs, expected_duration",
     (
-        ("RL 1", 0, 4, [], ["Rate Limiter RL 1 has reached its limit of 5 calls per 1 s", "Rate Limiter RL 1 has reached its limit of 5 calls per 1 s"], 1),  # noqa
-        ("RL 2", 0, 5, ["Rate Limiter RL 2 has reached its limit of 5 calls per 1 s", ], ["Rate Limiter RL 2 is back under its limit of 200 credits per 1 s"], 1),  # noqa
-        ("RL 3", 0.9, 6, ["Rate Limiter RL 3 has reached its limit of 5 calls per 1 s", "Rate Limiter RL 3 has reached its limit of 5 calls per 1 s"], [], 2),  # noqa
-    )
+        (lambda: CountRateLimiter(5, 1, name="RL 1"), None, 4, [], ["Rate Limiter RL 1 has reached its limit of 5 calls per 1 s", "Rate Limiter RL 1 has reached its limit of 5 calls per 1 s"], 1),  # noqa
+        (lambda: CountRateLimiter(5, 1, name="RL 2"), None, 5, ["Rate Limiter RL 2 has reached its limit of 5 calls per 1 s", ], ["Rate Limiter RL 2 is back under its limit of 200 credits per 1 s"], 1),  # noqa
+        (lambda: CountRateLimiter(5, 1, name="RL 3", adjustment=0.9), None, 6, ["Rate Limiter RL 3 has reached its limit of 5 calls per 1 s", "Rate Limiter RL 3 has reached its limit of 5 calls per 1 s"], [], 2.1),  # noqa
+        (lambda: CreditRateLimiter(200, 1, name="CRL 1", adjustment=0.5), 40, 4, [], ["Credit Rate Limiter CRL 3 is using more than 90% of its 200 credits per 1 s", "Credit Rate Limiter CRL 1 is back under its limit of 200 credits per 1 s"], 1),  # noqa
+        (lambda: CreditRateLimiter(200, 1, name="CRL 2", adjustment=0.5), 40, 5, ["Credit Rate Limiter CRL 2 is using more than 90% of its 200 credits per 1 s"], ["Credit Rate Limiter CRL 2 is back under its limit of 200 credits per 1 s"], 1),  # noqa
+        (lambda: CreditRateLimiter(200, 1, name="CRL 3", adjustment=1), 40, 6, ["Credit Rate Limiter CRL 3 is using more than 90% of its 200 credits per 1 s", "Credit Rate Limiter CRL 3 is back under its limit of 200 credits per 1 s"], [], 2),  # noqa
+    ),
+    ids=("RL 1", "RL 2", "RL 3", "CRL 1", "CRL 2", "CRL 3"),
 )
-async def test_rate_limiter(name, adjustment, calls, expected_logs, unexpected_logs, expected_duration, caplog):
-    rate_limiter = CountRateLimiter(5, 1, name=name, adjustment=adjustment)
+async def test_rate_limiter(limiter_factory, request_credits, calls, expected_logs, unexpected_logs, expected_duration, caplog, request):  # noqa
+    rate_limiter = limiter_factory()
     caplog.set_level(logging.DEBUG)
 
-    # @count_rate_limit(rate_limiter=rate_limiter)
-    @throughput(rate_limiter=rate_limiter)
-    async def simulate_api_call():
-        await asyncio.sleep(1)
+    simulate_api_call = _build_call(rate_limiter, request_credits)
 
-    coros = [simulate_api_call() for _ in range(calls)]
-    start = time.time()
-    await asyncio.gather(*coros)
-    duration = time.time() - start
-    print("Duration: ", duration, " / ", "Expected: ", expected_duration)
-    assert expected_duration * 0.9 < duration < expected_duration * 1.1
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(calls):
+            tg.create_task(simulate_api_call())
+    duration = loop.time() - start
+    request.node.user_properties.append(("duration", duration))
+    assert duration == pytest.approx(expected_duration, abs=1e-6)
 
     for log in expected_logs:
         assert log in caplog.text
 
+    for log in unexpected_logs:
+        assert log not in caplog.text
+
 
 @pytest.mark.parametrize(
-    "name, adjustment, calls, expected_logs, unexpected_logs, expected_duration",
+    "limiter_factory, request_credits",
     (
-        ("CRL 1", 0.5, 4, [], ["Credit Rate Limiter CRL 3 is using more than 90% of its 200 credits per 1 s", "Credit Rate Limiter CRL 1 is back under its limit of 200 credits per 1 s"], 1),  # noqa
-        ("CRL 2", 0.5, 5, ["Credit Rate Limiter CRL 2 is using more than 90% of its 200 credits per 1 s"], ["Credit Rate Limiter CRL 2 is back under its limit of 200 credits per 1 s"], 1),  # noqa
-        ("CRL 3", 1, 6, ["Credit Rate Limiter CRL 3 is using more than 90% of its 200 credits per 1 s", "Credit Rate Limiter CRL 3 is back under its limit of 200 credits per 1 s"], [], 2),  # noqa
-    )
+        (lambda: CountRateLimiter(10_000, 1, name="RL stress"), None),
+        (lambda: CreditRateLimiter(10_000, 1, name="CRL stress"), 1),
+    ),
+    ids=("RL stress", "CRL stress"),
 )
-async def test_credit_rate_limiter(name, adjustment, calls, expected_logs, unexpected_logs, expected_duration, caplog):
-    rate_limiter = CreditRateLimiter(200, 1, name=name, adjustment=adjustment)
-    caplog.set_level(logging.DEBUG)
-
-    # @credit_rate_limit(rate_limiter=rate_limiter, request_credits=40)
-    @throughput(rate_limiter, request_credits=40)
-    async def simulate_api_call():
+# spawning 1000 tasks below is one synchronous step that can exceed the
+# blocked-loop threshold on a loaded machine, so this check is skipped here
+@pytest.mark.allow_loop_blocking
+async def test_rate_limiter_high_concurrency(limiter_factory, request_credits):
+    # the limiter admits all 1000 calls at once: an implementation serializing its waiters
+    # (e.g. by sleeping under a lock) would be caught by the duration assertion
+    rate_limiter = limiter_factory()
+    simulate_api_call = _build_call(rate_limiter, request_credits)
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(1000):
+            tg.create_task(simulate_api_call())
+    duration = loop.time() - start
+    assert duration == pytest.approx(1, abs=1e-6)
+
+
+def test_rate_limiter_outlives_event_loop():
+    # a limiter reused across event loops (e.g. successive asyncio.run calls) must
+    # rebind to the new loop: a timer left armed on a dead loop would never fire
+    # again and the leaked capacity would deadlock the batches below
+    count_limiter = CountRateLimiter(3, 0.1, name="RL across loops")
+    credit_limiter = CreditRateLimiter(3, 0.1, name="CRL across loops")
+
+    async def run_batches():
+        # more calls than the allowance, so completion requires the releases to fire
+        for _ in range(4):
+            async with count_limiter:
+                pass
+        for _ in range(4):
+            async with credit_limiter(1):
+                pass
+
+    for _ in range(2):
+        asyncio.run(run_batches())
+
+
+class MyClassWithCreditRateLimiter:
+    # compiled once at import: the limiter itself is still built per instance, inside the test
+    def __init__(self):
+        self.my_credit_rate_limiter = CreditRateLimiter(200, 1, name="CRL as attribute", adjustment=1)
+
+    # @credit_rate_limit_with_attribute("my_credit_rate_limiter", 40)
+    @throughput(attribute_name="my_credit_rate_limiter", request_credits=40)
+    async def simulate_api_call(self):
         await asyncio.sleep(1)
 
-    coros = [simulate_api_call() for _ in range(calls)]
-    start = time.time()
-    await asyncio.gather(*coros)
-    duration = time.time() - start
-    print("Duration: ", duration, " / ", "Expected: ", expected_duration)
-    assert expected_duration * 0.9 < duration < expected_duration * 1.1
-
-    for log in expected_logs:
-        assert log in caplog.text
+    @count_rate_limit_with_attribute(attribute_name="my_credit_rate_limiter")
+    async def simulate_api_call_wrong_rate_limiter(self):
+        pass  # pragma: no cover
 
-    for log in unexpected_logs:
-        assert log not in caplog.text
 
+class MyClassWithCountRateLimiter:
+    def __init__(self):
+        self.my_rate_limiter = CountRateLimiter(5, 1, name="RL as attribute", adjustment=0.9)
 
-async def test_attribute_credit_rate_limiter():
-    class MyClass:
-        def __init__(self):
-            self.my_credit_rate_limiter = CreditRateLimiter(200, 1, name="CRL as attribute", adjustment=1)
+    # @rate_limit_with_attribute("my_rate_limiter")
+    @throughput(attribute_name="my_rate_limiter")
+    async def simulate_api_call(self):
+        await asyncio.sleep(1)
 
-        # @credit_rate_limit_with_attribute("my_credit_rate_limiter", 40)
-        @throughput(attribute_name="my_credit_rate_limiter", request_credits=40)
-        async def simulate_api_call(self):
-            await asyncio.sleep(1)
+    @credit_rate_limit_with_attribute(attribute_name="my_rate_limiter", request_credits=1)
+    async def simulate_api_call_wrong_rate_limiter(self):
+        pass  # pragma: no cover
 
-        @count_rate_limit_with_attribute(attribute_name="my_credit_rate_limiter")
-        async def simulate_api_call_wrong_rate_limiter(self):
-            pass  # pragma: no cover
 
-    my_class = MyClass()
-    coros = [my_class.simulate_api_call() for _ in range(6)]
-    start = time.time()
-    await asyncio.gather(*coros)
-    duration = time.time() - start
-    print("Duration: ", duration, " / ", "Expected: ", 2)
-    assert 2 * 0.9 < duration < 2 * 1.1
+async def test_attribute_credit_rate_limiter(request):
+    my_class = MyClassWithCreditRateLimiter()
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(6):
+            tg.create_task(my_class.simulate_api_call())
+    duration = loop.time() - start
+    request.node.user_properties.append(("duration", duration))
+    assert duration == pytest.approx(2, abs=1e-6)
 
     with pytest.raises(ValueError):
         await my_class.simulate_api_call_wrong_rate_limiter()
 
 
-async def test_attribute_rate_limiter():
-    class MyClass:
-        def __init__(self):
-            self.my_rate_limiter = CountRateLimiter(5, 1, name="RL as attribute", adjustment=0.9)
-
-        # @rate_limit_with_attribute("my_rate_limiter")
-        @throughput(attribute_name="my_rate_limiter")
-        async def simulate_api_call(self):
-            await asyncio.sleep(1)
-
-        @credit_rate_limit_with_attribute(attribute_name="my_rate_limiter", request_credits=1)
-        async def simulate_api_call_wrong_rate_limiter(self):
-            pass  # pragma: no cover
-
-    my_class = MyClass()
-    coros = [my_class.simulate_api_call() for _ in range(6)]
-    start = time.time()
-    await asyncio.gather(*coros)
-    duration = time.time() - start
-    print("Duration: ", duration, " / ", "Expected: ", 2)
-    assert 2 * 0.9 < duration < 2 * 1.1
+async def test_attribute_rate_limiter(request):
+    my_class = MyClassWithCountRateLimiter()
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(6):
+            tg.create_task(my_class.simulate_api_call())
+    duration = loop.time() - start
+    request.node.user_properties.append(("duration", duration))
+    assert duration == pytest.approx(2.1, abs=1e-6)
 
     with pytest.raises(ValueError):
         await my_class.simulate_api_call_wrong_rate_limiter()
 
 
-def test_exceptions():
-    with pytest.raises(ValueError):
-        throughput(rate_limiter=CreditRateLimiter(200, 1))
+async def test_reserve(request):
+    rate_limiter = CreditRateLimiter(200, 1, name="CRL reserve", adjustment=1)
 
-    with pytest.raises(ValueError):
-        throughput(rate_limiter=CreditRateLimiter(200, 1), attribute_name="rate_limiter")
+    async def simulate_api_call():
+        await asyncio.sleep(1)
 
-    with pytest.raises(ValueError):
-        throughput(rate_limiter=CountRateLimiter(5, 1), attribute_name="rate_limiter")
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    async with rate_limiter.reserve(4 * 40):
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(4):
+                tg.create_task(simulate_api_call())
 
-    with pytest.raises(ValueError):
-        throughput(rate_limiter=CountRateLimiter(5, 1), request_credits=1)
+    # the second batch does not fit in the remaining credits, so it waits for the first reservation to be released
+    async with rate_limiter.reserve(3 * 40):
+        async with asyncio.TaskGroup() as tg:
+            for _ in range(3):
+                tg.create_task(simulate_api_call())
+    duration = loop.time() - start
+    request.node.user_properties.append(("duration", duration))
+    assert duration == pytest.approx(2, abs=1e-6)
 
-    with pytest.raises(ValueError):
-        throughput()
 
+@pytest.mark.parametrize(
+    "kwargs_factory",
+    (
+        lambda: {"rate_limiter": CreditRateLimiter(200, 1)},
+        lambda: {"rate_limiter": CreditRateLimiter(200, 1), "attribute_name": "rate_limiter"},
+        lambda: {"rate_limiter": CountRateLimiter(5, 1), "attribute_name": "rate_limiter"},
+        lambda: {"rate_limiter": CountRateLimiter(5, 1), "request_credits": 1},
+        lambda: {},
+        lambda: {"request_credits": 10},
+    ),
+    ids=(
+        "CreditRateLimiter without request_credits",
+        "CreditRateLimiter with attribute_name",
+        "CountRateLimiter with attribute_name",
+        "CountRateLimiter with request_credits",
+        "no parameter",
+        "request_credits only",
+    ),
+)
+def test_exceptions(kwargs_factory):
+    # the factories build the limiters inside the test, not at collection time
     with pytest.raises(ValueError):
-        throughput(request_credits=10)
+        throughput(**kwargs_factory())